@@ -9,7 +9,7 @@ from threading import Thread
 
 import pandas as pd
 import requests
-from bs4 import BeautifulSoup
+from selectolax.lexbor import LexborHTMLParser
 
 # ----------------------------
 # Configuration
@@ -46,14 +46,11 @@ TASK_QUEUE: "Queue[tuple]" = Queue()
 # Helpers
 # ----------------------------
 
-def extract_dropdown_values(soup: BeautifulSoup):
-    sel = soup.find("select", attrs={"name": "ddparams"})
-    if not sel:
-        return []
+def extract_dropdown_values(tree: LexborHTMLParser):
     options = []
-    for opt in sel.find_all("option"):
-        value = opt.get("value", "").strip()
-        label = opt.text.strip()
+    for opt in tree.css('select[name="ddparams"] option'):
+        value = (opt.attributes.get("value") or "").strip()
+        label = opt.text(strip=True)
         if value and label and value.lower() != "null":
             options.append((value, label))
     return options
@@ -68,38 +65,38 @@ def build_post_url(level: int, year: int) -> str:
     )
 
 
-def get_html_for_year(year: int) -> BeautifulSoup:
+def get_html_for_year(year: int) -> LexborHTMLParser:
     path = os.path.join(HTML_DIR, f"Distribution-Nationwide {year}.html")
     with open(path, encoding="utf-8") as f:
-        return BeautifulSoup(f.read(), "lxml")
+        return LexborHTMLParser(f.read())
 
 
-def submit_and_parse(session: requests.Session, url: str, ddvalue: str) -> BeautifulSoup:
+def submit_and_parse(session: requests.Session, url: str, ddvalue: str) -> LexborHTMLParser:
     time.sleep(0.01)
     resp = session.post(url, headers=HEADERS, data={"ddparams": ddvalue, "submit": "Submit"})
     resp.raise_for_status()
     time.sleep(0.01)
-    return BeautifulSoup(resp.text, "lxml")
+    return LexborHTMLParser(resp.text)
 
 
 def sanitize_filename(name: str) -> str:
     return re.sub(r"[^\w\s-]", "", name).replace(" ", "_")
 
 
-def extract_and_save_tables(soup: BeautifulSoup, outdir: str, place_name: str, year: int, level: str):
+def extract_and_save_tables(tree: LexborHTMLParser, outdir: str, place_name: str, year: int, level: str):
     os.makedirs(outdir, exist_ok=True)
-    for table in soup.find_all("table", class_="RepT"):
-        table_id = table.get("id", "")
+    for table in tree.css("table.RepT"):
+        table_id = table.attributes.get("id") or ""
         match = re.match(r"treport([A-Z])", table_id)
         if not match:
             continue
         category_letter = match.group(1)
 
-        rows = table.find_all("tr")
+        rows = table.css("tr")
         data = [
-            [cell.get_text(strip=True) for cell in row.find_all(["td", "th"])]
+            [cell.text(strip=True) for cell in row.css("td, th")]
             for row in rows
-            if row.find_all(["td", "th"])
+            if row.css_first("td, th") is not None
         ]
         if len(data) < 2:
             continue
@@ -121,9 +118,9 @@ def process_municipality(year: int, province_dir: str, muni_val: str, muni_label
     try:
         with requests.Session() as session:
             url_muni = build_post_url(level=4, year=year)
-            muni_soup = submit_and_parse(session, url_muni, muni_val)
+            muni_tree = submit_and_parse(session, url_muni, muni_val)
         muni_dir = os.path.join(province_dir, sanitize_filename(muni_label))
-        extract_and_save_tables(muni_soup, muni_dir, muni_label, year, "Municipality")
+        extract_and_save_tables(muni_tree, muni_dir, muni_label, year, "Municipality")
     except Exception as exc:  # pylint: disable=broad-except
         print(f"❌ Error in municipality {muni_label}: {exc}")
 
@@ -132,11 +129,11 @@ def process_province(year: int, region_dir: str, province_val: str, province_lab
     try:
         with requests.Session() as session:
             url_prov = build_post_url(level=3, year=year)
-            province_soup = submit_and_parse(session, url_prov, province_val)
+            province_tree = submit_and_parse(session, url_prov, province_val)
         province_dir = os.path.join(region_dir, sanitize_filename(province_label))
-        extract_and_save_tables(province_soup, province_dir, province_label, year, "Province")
+        extract_and_save_tables(province_tree, province_dir, province_label, year, "Province")
 
-        for muni_val, muni_label in extract_dropdown_values(province_soup):
+        for muni_val, muni_label in extract_dropdown_values(province_tree):
             submit(process_municipality, year, province_dir, muni_val, muni_label)
     except Exception as exc:  # pylint: disable=broad-except
         print(f"❌ Error in province {province_label}: {exc}")
@@ -146,11 +143,11 @@ def process_region(year: int, region_val: str, region_label: str):
     try:
         with requests.Session() as session:
             url_region = build_post_url(level=2, year=year)
-            region_soup = submit_and_parse(session, url_region, region_val)
+            region_tree = submit_and_parse(session, url_region, region_val)
         region_dir = os.path.join(OUT_DIR, str(year), sanitize_filename(region_label))
-        extract_and_save_tables(region_soup, region_dir, region_label, year, "Region")
+        extract_and_save_tables(region_tree, region_dir, region_label, year, "Region")
 
-        for province_val, province_label in extract_dropdown_values(region_soup):
+        for province_val, province_label in extract_dropdown_values(region_tree):
             submit(process_province, year, region_dir, province_val, province_label)
     except Exception as exc:  # pylint: disable=broad-except
         print(f"❌ Error in region {region_label}: {exc}")
@@ -159,8 +156,8 @@ def process_region(year: int, region_val: str, region_label: str):
 def process_year(year: int):
     try:
         print(f"\n🔍 Processing year: {year}")
-        entry_soup = get_html_for_year(year)
-        for region_val, region_label in extract_dropdown_values(entry_soup):
+        entry_tree = get_html_for_year(year)
+        for region_val, region_label in extract_dropdown_values(entry_tree):
             submit(process_region, year, region_val, region_label)
     except Exception as exc:  # pylint: disable=broad-except
         print(f"❌ Could not initialize year {year}: {exc}")
@@ -1,19 +1,27 @@
 #!/usr/bin/env python3
-"""Run both NDHRHIS ownership and complete scrapers in one go."""
+"""Run both NDHRHIS ownership and complete scrapers in one go.
+
+Every place is fetched once with the A-E view; the ownership CSVs are
+taken from its table E, so a single traversal feeds both output trees.
+"""
 
 from __future__ import annotations
 
+import csv
 import os
 import re
 import time
+from concurrent.futures import Future, ThreadPoolExecutor, wait
 from dataclasses import dataclass
-from queue import Queue
-from threading import Thread
+from functools import lru_cache
+from threading import BoundedSemaphore, Lock
 from typing import Callable
 
-import pandas as pd
 import requests
-from bs4 import BeautifulSoup
+import requests_cache
+from requests.adapters import HTTPAdapter
+from selectolax.lexbor import LexborHTMLParser, LexborNode
+from urllib3.util.retry import Retry
 
 # ----------------------------
 # Configuration
@@ -36,111 +44,241 @@ HEADERS = {
     "Referer": "https://ndhrhis.doh.gov.ph/RPA0001b.php",
     "Origin": "https://ndhrhis.doh.gov.ph",
     "Content-Type": "application/x-www-form-urlencoded",
+    # "br" needs the brotli package for urllib3 to decode it.
+    "Accept-Encoding": "gzip, deflate, br",
 }
 
-TableSaver = Callable[[BeautifulSoup, str, str, int, str], None]
+# Workers mostly block on the network, so run more of them than there are
+# request slots; the spare threads parse and write CSVs meanwhile.
+MAX_WORKERS = 30
+# Cap on simultaneous requests to the NDHRHIS host, across all workers.
+MAX_HOST_REQUESTS = 20
+# Shared politeness budget for requests that actually reach the server.
+MAX_REQUESTS_PER_SECOND = 50
+
+# Statuses worth retrying; urllib3 backs off (honouring Retry-After) before
+# a task gives up and is re-enqueued, up to MAX_TASK_ATTEMPTS times.
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+MAX_TASK_ATTEMPTS = 3
+# (connect, read) seconds; a stalled POST raises Timeout instead of holding a
+# HOST_SEM slot forever, so it goes through the same retry path.
+REQUEST_TIMEOUT = (10, 60)
+
+# Cached responses live for CACHE_EXPIRE_AFTER seconds regardless of the
+# server's Cache-Control/Expires headers (PHP pages typically send no-store),
+# then are revalidated with ETag/Last-Modified when the server provided them.
+CACHE_NAME = "ndhrhis.sqlite"
+CACHE_EXPIRE_AFTER = 86400
+
+# Ownership breakdown within the A-E page; the only table written to output_csv.
+OWNERSHIP_TABLE_ID = "treportE"
+
+_SANITIZE_RE = re.compile(r"[^\w\s-]")
+_TREPORT_RE = re.compile(r"treport([A-Z])")
+_CELL_TAGS = frozenset({"td", "th"})
+
+TableSaver = Callable[[LexborHTMLParser, str, str, int, str], None]
 
 
 @dataclass(frozen=True)
 class ScrapeConfig:
     name: str
     html_dir: str
-    out_dir: str
     sbrep: str
-    save_tables: TableSaver
-    max_workers: int = 14
+    # (out_dir, saver) pairs; every fetched page is handed to each saver.
+    outputs: tuple[tuple[str, TableSaver], ...]
+    max_workers: int = MAX_WORKERS
+
+
+class RateLimiter:
+    """Hand out evenly spaced time slots to callers across all threads."""
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate
+        self._lock = Lock()
+        self._next_slot = time.monotonic()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            slot = max(self._next_slot, now)
+            self._next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class PacedRetry(Retry):
+    """urllib3 Retry that also takes a RATE_LIMITER slot before each retry."""
+
+    def sleep(self, response=None):
+        super().sleep(response)
+        RATE_LIMITER.wait()
 
 
 # ----------------------------
 # Shared helpers
 # ----------------------------
 
-def extract_dropdown_values(soup: BeautifulSoup):
-    sel = soup.find("select", attrs={"name": "ddparams"})
-    if not sel:
-        return []
+def extract_dropdown_values(tree: LexborHTMLParser):
     options = []
-    for opt in sel.find_all("option"):
-        value = opt.get("value", "").strip()
-        label = opt.text.strip()
+    for opt in tree.css('select[name="ddparams"] option'):
+        value = (opt.attributes.get("value") or "").strip()
+        label = opt.text(strip=True)
         if value and label and value.lower() != "null":
             options.append((value, label))
     return options
 
 
 def sanitize_filename(name: str) -> str:
-    return re.sub(r"[^\w\s-]", "", name).replace(" ", "_")
+    return _SANITIZE_RE.sub("", name).replace(" ", "_")
 
 
-def build_post_url(level: int, year: int, config: ScrapeConfig) -> str:
+def build_session(max_workers: int = MAX_WORKERS) -> requests.Session:
+    # POST bodies (ddparams) are part of requests-cache's default cache key.
+    session = requests_cache.CachedSession(
+        CACHE_NAME,
+        backend="sqlite",
+        allowable_methods=("GET", "POST"),
+        cache_control=False,
+        expire_after=CACHE_EXPIRE_AFTER,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=max_workers,
+        pool_maxsize=max_workers * 2,
+        max_retries=PacedRetry(
+            total=5,
+            backoff_factor=0.5,
+            status_forcelist=RETRY_STATUSES,
+            allowed_methods=["POST", "GET"],
+            respect_retry_after_header=True,
+            # Hand the last response back so raise_for_status() reports it.
+            raise_on_status=False,
+        ),
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers.update(HEADERS)
+    return session
+
+
+HOST_SEM = BoundedSemaphore(MAX_HOST_REQUESTS)
+RATE_LIMITER = RateLimiter(MAX_REQUESTS_PER_SECOND)
+
+_MKDIR_CACHE: set[str] = set()
+_MKDIR_LOCK = Lock()
+
+
+@lru_cache(maxsize=None)
+def _build_post_url(level: int, year: int, sbrep: str) -> str:
     seqn, title, gdate = YEAR_CONFIG[year]
     return (
         f"{BASE_URL}/system.bcall.page.php?xcrs=RPA0001b.php&prm="
         f"level={level}^year={year}^seqn={seqn}^title={title}^gdate={gdate}^"
-        f"allfltr=0^prvslct=A^prvlist=^sbrep={config.sbrep}"
+        f"allfltr=0^prvslct=A^prvlist=^sbrep={sbrep}"
     )
 
 
-def get_html_for_year(year: int, config: ScrapeConfig) -> BeautifulSoup:
-    path = os.path.join(config.html_dir, f"Distribution-Nationwide {year}.html")
-    with open(path, encoding="utf-8") as f:
-        return BeautifulSoup(f.read(), "lxml")
+def build_post_url(level: int, year: int, config: ScrapeConfig) -> str:
+    return _build_post_url(level, year, config.sbrep)
 
 
-def submit_and_parse(session: requests.Session, url: str, ddvalue: str) -> BeautifulSoup:
-    time.sleep(0.01)
-    resp = session.post(url, headers=HEADERS, data={"ddparams": ddvalue, "submit": "Submit"})
+def is_transient(exc: requests.RequestException) -> bool:
+    if isinstance(exc, requests.HTTPError) and exc.response is not None:
+        return exc.response.status_code in RETRY_STATUSES
+    # Exhausted urllib3 retries on dropped or stalled connections surface as
+    # ConnectionError; bad URLs, redirect loops, decoding errors are permanent.
+    return isinstance(exc, (requests.ConnectionError, requests.Timeout))
+
+
+def get_html_for_year(year: int, config: ScrapeConfig) -> LexborHTMLParser:
+    path = os.path.join(config.html_dir, f"Distribution-Nationwide {year}.html")
+    with open(path, "rb") as f:
+        return LexborHTMLParser(f.read())
+
+
+def get_fresh_cached(session: requests.Session, url: str, data: dict) -> requests.Response | None:
+    cache = getattr(session, "cache", None)
+    if cache is None:
+        return None
+    key = cache.create_key(session.prepare_request(requests.Request("POST", url, data=data)))
+    cached = cache.get_response(key)
+    if cached is None or cached.is_expired:
+        return None
+    return cached
+
+
+def submit_and_parse(session: requests.Session, url: str, ddvalue: str) -> LexborHTMLParser:
+    data = {"ddparams": ddvalue, "submit": "Submit"}
+    # Fresh cache entries are used as-is and skip the budget. Anything else
+    # (including revalidating an expired entry) takes its slot only once it
+    # holds a host slot, so the request goes out as soon as the slot is granted.
+    resp = get_fresh_cached(session, url, data)
+    if resp is None:
+        with HOST_SEM:
+            RATE_LIMITER.wait()
+            resp = session.post(url, data=data, timeout=REQUEST_TIMEOUT)
     resp.raise_for_status()
-    time.sleep(0.01)
-    return BeautifulSoup(resp.text, "lxml")
+    return LexborHTMLParser(resp.content)
+
+
+def ensure_dir(path: str):
+    with _MKDIR_LOCK:
+        if path in _MKDIR_CACHE:
+            return
+    os.makedirs(path, exist_ok=True)
+    with _MKDIR_LOCK:
+        _MKDIR_CACHE.add(path)
+
+
+def write_csv(path: str, data: list[list[str]]):
+    with open(path, "w", newline="", encoding="utf-8", buffering=1 << 16) as f:
+        csv.writer(f, lineterminator="\n").writerows(data)
 
 
 # ----------------------------
 # Table extraction variants
 # ----------------------------
 
-def save_ownership_tables(soup: BeautifulSoup, outdir: str, name: str, year: int, level: str):
-    os.makedirs(outdir, exist_ok=True)
-    tables = soup.find_all("table")
-    count = 0
-    for table in tables:
-        rows = table.find_all("tr")
-        data = [
-            [cell.get_text(strip=True) for cell in row.find_all(["td", "th"])]
-            for row in rows
-            if row.find_all(["td", "th"])
+def extract_rows(table: LexborNode) -> list[list[str]]:
+    data = []
+    for row in table.css("tr"):
+        # The HTML parser always nests cells directly under <tr>, so walking
+        # the children is enough and avoids a CSS query per row.
+        cells = [
+            cell.text(deep=True, strip=True)
+            for cell in row.iter(include_text=False)
+            if cell.tag in _CELL_TAGS
         ]
-        if len(data) < 2:
-            continue
-        df = pd.DataFrame(data[1:], columns=data[0])
-        fname = f"{sanitize_filename(name)}.csv"
-        df.to_csv(os.path.join(outdir, fname), index=False)
-        print(f"✅ Saved CSV: {year}/{level}/{fname}")
-        count += 1
-    if count == 0:
+        if cells:
+            data.append(cells)
+    return data
+
+
+def save_ownership_tables(tree: LexborHTMLParser, outdir: str, name: str, year: int, level: str):
+    ensure_dir(outdir)
+    table = tree.css_first(f"table#{OWNERSHIP_TABLE_ID}")
+    data = extract_rows(table) if table is not None else []
+    if len(data) < 2:
         print(f"⚠️ No valid tables found for {year}/{level}/{name}")
+        return
+    fname = f"{sanitize_filename(name)}.csv"
+    write_csv(os.path.join(outdir, fname), data)
+    print(f"✅ Saved CSV: {year}/{level}/{fname}")
 
 
-def save_complete_tables(soup: BeautifulSoup, outdir: str, place_name: str, year: int, level: str):
-    os.makedirs(outdir, exist_ok=True)
-    for table in soup.find_all("table", class_="RepT"):
-        table_id = table.get("id", "")
-        match = re.match(r"treport([A-Z])", table_id)
+def save_complete_tables(tree: LexborHTMLParser, outdir: str, place_name: str, year: int, level: str):
+    ensure_dir(outdir)
+    for table in tree.css('table.RepT[id^="treport"]'):
+        table_id = table.attributes.get("id") or ""
+        match = _TREPORT_RE.match(table_id)
         if not match:
             continue
         category_letter = match.group(1)
-
-        rows = table.find_all("tr")
-        data = [
-            [cell.get_text(strip=True) for cell in row.find_all(["td", "th"])]
-            for row in rows
-            if row.find_all(["td", "th"])
-        ]
+        data = extract_rows(table)
         if len(data) < 2:
             continue
-        df = pd.DataFrame(data[1:], columns=data[0])
         fname = f"{sanitize_filename(place_name)}_TABLE_{category_letter}.csv"
-        df.to_csv(os.path.join(outdir, fname), index=False)
+        write_csv(os.path.join(outdir, fname), data)
         print(f"✅ Saved CSV: {year}/{level}/{fname}")
 
 
@@ -150,106 +288,121 @@ def save_complete_tables(soup: BeautifulSoup, outdir: str, place_name: str, year
 
 def run_scrape(config: ScrapeConfig):
     print(f"\n🚀 Starting {config.name} scrape")
-    os.makedirs(config.out_dir, exist_ok=True)
+    for out_dir, _ in config.outputs:
+        ensure_dir(out_dir)
 
-    task_queue: Queue[tuple[Callable, tuple]] = Queue()
+    session = build_session(config.max_workers)
+    executor = ThreadPoolExecutor(max_workers=config.max_workers)
+    futures: set[Future] = set()
+    futures_lock = Lock()
 
     def submit(task: Callable, *args):
-        task_queue.put((task, args))
-
-    def worker():
-        while True:
-            item = task_queue.get()
-            if item is None:
-                task_queue.task_done()
-                break
-            func, args = item
-            try:
-                func(*args)
-            finally:
-                task_queue.task_done()
-
-    def process_municipality(year: int, province_dir: str, muni_val: str, muni_label: str):
+        future = executor.submit(task, *args)
+        with futures_lock:
+            futures.add(future)
+
+    def retry_or_give_up(
+        task: Callable, what: str, exc: requests.RequestException, attempt: int, *args
+    ):
+        if attempt < MAX_TASK_ATTEMPTS and is_transient(exc):
+            print(f"🔁 [{config.name}] {what} (attempt {attempt}): {exc}")
+            submit(task, *args, attempt + 1)
+        else:
+            print(f"❌ [{config.name}] {what}: {exc}")
+
+    def save_tables(tree: LexborHTMLParser, rel_dir: str, name: str, year: int, level: str):
+        for out_dir, saver in config.outputs:
+            saver(tree, os.path.join(out_dir, rel_dir), name, year, level)
+
+    def process_municipality(
+        year: int, province_dir: str, muni_val: str, muni_label: str, attempt: int = 1
+    ):
         try:
-            with requests.Session() as session:
-                url = build_post_url(level=4, year=year, config=config)
-                muni_soup = submit_and_parse(session, url, muni_val)
+            url = build_post_url(level=4, year=year, config=config)
+            muni_tree = submit_and_parse(session, url, muni_val)
             muni_dir = os.path.join(province_dir, sanitize_filename(muni_label))
-            config.save_tables(muni_soup, muni_dir, muni_label, year, "Municipality")
+            save_tables(muni_tree, muni_dir, muni_label, year, "Municipality")
+        except requests.RequestException as exc:
+            retry_or_give_up(
+                process_municipality, f"municipality {muni_label}", exc, attempt,
+                year, province_dir, muni_val, muni_label,
+            )
         except Exception as exc:  # pylint: disable=broad-except
             print(f"❌ [{config.name}] municipality {muni_label}: {exc}")
 
-    def process_province(year: int, region_dir: str, province_val: str, province_label: str):
+    def process_province(
+        year: int, region_dir: str, province_val: str, province_label: str, attempt: int = 1
+    ):
         try:
-            with requests.Session() as session:
-                url = build_post_url(level=3, year=year, config=config)
-                province_soup = submit_and_parse(session, url, province_val)
+            url = build_post_url(level=3, year=year, config=config)
+            province_tree = submit_and_parse(session, url, province_val)
             province_dir = os.path.join(region_dir, sanitize_filename(province_label))
-            config.save_tables(province_soup, province_dir, province_label, year, "Province")
+            save_tables(province_tree, province_dir, province_label, year, "Province")
 
-            for muni_val, muni_label in extract_dropdown_values(province_soup):
+            for muni_val, muni_label in extract_dropdown_values(province_tree):
                 submit(process_municipality, year, province_dir, muni_val, muni_label)
+        except requests.RequestException as exc:
+            retry_or_give_up(
+                process_province, f"province {province_label}", exc, attempt,
+                year, region_dir, province_val, province_label,
+            )
         except Exception as exc:  # pylint: disable=broad-except
             print(f"❌ [{config.name}] province {province_label}: {exc}")
 
-    def process_region(year: int, region_val: str, region_label: str):
+    def process_region(year: int, region_val: str, region_label: str, attempt: int = 1):
         try:
-            with requests.Session() as session:
-                url = build_post_url(level=2, year=year, config=config)
-                region_soup = submit_and_parse(session, url, region_val)
-            region_dir = os.path.join(config.out_dir, str(year), sanitize_filename(region_label))
-            config.save_tables(region_soup, region_dir, region_label, year, "Region")
+            url = build_post_url(level=2, year=year, config=config)
+            region_tree = submit_and_parse(session, url, region_val)
+            region_dir = os.path.join(str(year), sanitize_filename(region_label))
+            save_tables(region_tree, region_dir, region_label, year, "Region")
 
-            for province_val, province_label in extract_dropdown_values(region_soup):
+            for province_val, province_label in extract_dropdown_values(region_tree):
                 submit(process_province, year, region_dir, province_val, province_label)
+        except requests.RequestException as exc:
+            retry_or_give_up(
+                process_region, f"region {region_label}", exc, attempt,
+                year, region_val, region_label,
+            )
         except Exception as exc:  # pylint: disable=broad-except
             print(f"❌ [{config.name}] region {region_label}: {exc}")
 
     def process_year(year: int):
         try:
             print(f"\n🔍 [{config.name}] Processing year: {year}")
-            entry_soup = get_html_for_year(year, config)
-            for region_val, region_label in extract_dropdown_values(entry_soup):
+            entry_tree = get_html_for_year(year, config)
+            for region_val, region_label in extract_dropdown_values(entry_tree):
                 submit(process_region, year, region_val, region_label)
         except Exception as exc:  # pylint: disable=broad-except
             print(f"❌ [{config.name}] could not initialize year {year}: {exc}")
 
-    workers = [Thread(target=worker, daemon=True) for _ in range(config.max_workers)]
-    for thread in workers:
-        thread.start()
+    with session, executor:
+        for year in sorted(YEAR_CONFIG):
+            submit(process_year, year)
 
-    for year in sorted(YEAR_CONFIG):
-        process_year(year)
-
-    task_queue.join()
-
-    for _ in workers:
-        task_queue.put(None)
-    for thread in workers:
-        thread.join()
+        # Tasks enqueue their children before returning, so once a batch is
+        # done any follow-up work is already in `futures`.
+        while True:
+            with futures_lock:
+                pending = set(futures)
+                futures.clear()
+            if not pending:
+                break
+            wait(pending)
 
     print(f"\n✅ Finished {config.name} scrape")
 
 
 def main():
-    configs = [
-        ScrapeConfig(
-            name="Ownership",
-            html_dir="uploaded_html",
-            out_dir="output_csv",
-            sbrep="E",
-            save_tables=save_ownership_tables,
-        ),
-        ScrapeConfig(
-            name="Complete",
-            html_dir="complete_html",
-            out_dir="complete_csv",
-            sbrep="A%20B%20C%20D%20E",
-            save_tables=save_complete_tables,
+    config = ScrapeConfig(
+        name="Ownership + Complete",
+        html_dir="complete_html",
+        sbrep="A%20B%20C%20D%20E",
+        outputs=(
+            ("output_csv", save_ownership_tables),
+            ("complete_csv", save_complete_tables),
         ),
-    ]
-    for config in configs:
-        run_scrape(config)
+    )
+    run_scrape(config)
 
 
 if __name__ == "__main__":